@@ -0,0 +1,31 @@
+//! Page-cache hints for files read once from start to end. Where
+//! `posix_fadvise` is unavailable these are no-ops, and since they are only
+//! hints, failures are ignored everywhere.
+
+use std::fs::File;
+
+#[cfg(any(target_os = "linux", target_os = "android", target_os = "freebsd"))]
+fn advise(file: &File, advice: libc::c_int) {
+    use std::os::unix::io::AsRawFd;
+
+    // SAFETY: `file` is an open descriptor; a zero length covers the whole file.
+    unsafe {
+        libc::posix_fadvise(file.as_raw_fd(), 0, 0, advice);
+    }
+}
+
+/// Lets the kernel use a larger readahead window for `file`.
+pub fn sequential(file: &File) {
+    #[cfg(any(target_os = "linux", target_os = "android", target_os = "freebsd"))]
+    advise(file, libc::POSIX_FADV_SEQUENTIAL);
+    #[cfg(not(any(target_os = "linux", target_os = "android", target_os = "freebsd")))]
+    let _ = file;
+}
+
+/// Starts reading `file` into the page cache in the background.
+pub fn will_need(file: &File) {
+    #[cfg(any(target_os = "linux", target_os = "android", target_os = "freebsd"))]
+    advise(file, libc::POSIX_FADV_WILLNEED);
+    #[cfg(not(any(target_os = "linux", target_os = "android", target_os = "freebsd")))]
+    let _ = file;
+}
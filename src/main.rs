@@ -1,125 +1,561 @@
+mod fadvise;
+#[cfg(unix)]
+mod mmap;
+mod newline;
+mod pool;
+
 use std::{
+    cell::Cell,
+    cmp::Reverse,
+    collections::VecDeque,
     fs::{self, File},
-    io::Read,
+    io::{self, Read},
+    mem,
+    num::NonZeroUsize,
     path::{Path, PathBuf},
-    sync::Arc,
+    sync::{
+        atomic::{AtomicUsize, Ordering},
+        mpsc, Arc, OnceLock,
+    },
+    thread,
 };
 
 use parking_lot::Mutex;
+use pool::ThreadPool;
 
-trait GenericInputData<T> {
-    fn read(&self) -> T;
-}
+trait GenericInputData: Send + Sync {
+    /// Size of the input in bytes, used to decide how inputs are batched.
+    fn size(&self) -> u64;
 
-trait Mapper {
-    fn map(&mut self);
+    /// Hints that the input will be read soon, so fetching it can overlap
+    /// with other work. Does nothing by default.
+    fn prefetch(&self) {}
+
+    /// Feeds the input to `f` chunk by chunk, in order.
+    fn read_chunks(&self, f: &mut dyn FnMut(&[u8]));
 }
 
-trait Reducer {
-    fn reduce(&mut self, other: &dyn MapReducer);
+/// A unit of work: `map` computes a partial result, which `execute` collects
+/// through `get_result` and sums.
+trait MapReducer: Send {
+    fn map(&mut self);
     fn get_result(&self) -> usize;
-}
 
-trait MapReducer: Mapper + Reducer {}
+    /// Hints that `map` will run soon, so its input can be fetched while
+    /// other workers are mapped. Does nothing by default.
+    fn prefetch(&self) {}
+}
 
+/// Counts the lines of one large input, or of a batch of small ones processed
+/// sequentially so they share a single worker.
 #[derive(Clone)]
 struct LineCountWorker {
-    input_data: Arc<dyn GenericInputData<String>>,
+    inputs: Box<[Arc<dyn GenericInputData>]>,
     result: usize,
 }
 
-impl Mapper for LineCountWorker {
+impl MapReducer for LineCountWorker {
     fn map(&mut self) {
-        let data = self.input_data.read();
-        self.result = data.lines().count();
-    }
-}
-
-impl Reducer for LineCountWorker {
-    fn reduce(&mut self, other: &dyn MapReducer) {
-        self.result += other.get_result();
+        self.result = self
+            .inputs
+            .iter()
+            .enumerate()
+            .map(|(index, input_data)| {
+                // Have the next input read in the background while this one
+                // is being counted.
+                if let Some(next) = self.inputs.get(index + 1) {
+                    next.prefetch();
+                }
+                let mut counter = newline::LineCounter::default();
+                input_data.read_chunks(&mut |chunk| {
+                    if chunk.len() < newline::SPLIT_THRESHOLD {
+                        counter.feed(chunk);
+                    } else {
+                        // A very large chunk is split across the cores no
+                        // other map work is using, if any. Cores are only
+                        // reserved once such a chunk arrives, which only a
+                        // memory-mapped input hands over.
+                        let extra_cores = CoreReservation::take(available_cores() - 1);
+                        counter.feed_split(chunk, 1 + extra_cores.0);
+                    }
+                });
+                counter.finish()
+            })
+            .sum();
     }
 
     fn get_result(&self) -> usize {
         self.result
     }
-}
 
-impl MapReducer for LineCountWorker {}
+    fn prefetch(&self) {
+        if let Some(input_data) = self.inputs.first() {
+            input_data.prefetch();
+        }
+    }
+}
 
 struct FileInputData {
-    file_path: PathBuf,
+    file_path: Box<Path>,
+    size: u64,
+    /// File opened by `prefetch`, handed to the next read so the input is
+    /// only opened once.
+    prefetched: Mutex<Option<File>>,
+}
+
+/// Size of the buffer used to stream files that cannot be memory-mapped. It
+/// fits in L2, so each chunk is counted while still cache-hot from the copy
+/// out of the kernel.
+const READ_CHUNK_SIZE: usize = 256 << 10;
+
+thread_local! {
+    /// Streaming buffer reused by every input read on this thread.
+    static READ_BUF: Cell<Box<[u8]>> = Cell::default();
 }
 
 impl FileInputData {
-    fn new(file_path: PathBuf) -> Self {
-        Self { file_path }
+    fn new(file_path: PathBuf, size: u64) -> Self {
+        Self {
+            file_path: file_path.into_boxed_path(),
+            size,
+            prefetched: Mutex::new(None),
+        }
+    }
+
+    fn open(&self) -> File {
+        match self.prefetched.lock().take() {
+            Some(file) => file,
+            None => File::open(&self.file_path).expect("Failed to open file"),
+        }
     }
 }
 
-impl<T> GenericInputData<T> for FileInputData
-where
-    T: From<String>,
-{
-    fn read(&self) -> T {
-        let mut file = File::open(&self.file_path).expect("Failed to open file");
-        let mut content = String::new();
-        file.read_to_string(&mut content)
-            .expect("Failed to read file");
-        T::from(content)
+impl GenericInputData for FileInputData {
+    fn size(&self) -> u64 {
+        self.size
+    }
+
+    fn prefetch(&self) {
+        if let Ok(file) = File::open(&self.file_path) {
+            fadvise::will_need(&file);
+            *self.prefetched.lock() = Some(file);
+        }
+    }
+
+    /// Hands over the whole memory map in one chunk, so the count scans the
+    /// page cache directly instead of a copy. Files that cannot be mapped are
+    /// streamed through a fixed-size buffer, so memory use stays constant
+    /// regardless of file size.
+    fn read_chunks(&self, f: &mut dyn FnMut(&[u8])) {
+        let mut file = self.open();
+
+        // A mapping large enough to be split may be scanned from several
+        // offsets at once, so it gets no sequential-access hint.
+        #[cfg(unix)]
+        let sequential = self.size < newline::SPLIT_THRESHOLD as u64;
+        // SAFETY: inputs are not modified or truncated while a run counts
+        // them; that is a precondition of running the tool. Files that cannot
+        // be mapped, including those that report a size of zero, fall back to
+        // streaming below.
+        #[cfg(unix)]
+        let mapped = unsafe { mmap::Mmap::map(&file, sequential) }
+            .map(|map| f(&map))
+            .is_ok();
+        #[cfg(not(unix))]
+        let mapped = false;
+
+        if !mapped {
+            // Streamed chunks are never split, so the scan is sequential.
+            fadvise::sequential(&file);
+            let mut buf = READ_BUF.take();
+            if buf.is_empty() {
+                buf = vec![0; READ_CHUNK_SIZE].into_boxed_slice();
+            }
+            loop {
+                match file.read(&mut buf) {
+                    Ok(0) => break,
+                    Ok(n) => f(&buf[..n]),
+                    Err(err) if err.kind() == io::ErrorKind::Interrupted => {}
+                    Err(err) => panic!("Failed to read file: {err:?}"),
+                }
+            }
+            READ_BUF.set(buf);
+        }
     }
 }
 
-fn generate_inputs<T>(data_dir: &str) -> Vec<Box<dyn GenericInputData<T>>>
-where
-    T: From<String>,
-{
-    let path = Path::new(data_dir);
-    let mut inputs = Vec::new();
-    if path.is_dir() {
-        for entry in fs::read_dir(path)
-            .expect("Failed to read directory")
-            .flatten()
-        {
-            let file_path = entry.path();
-            let input_data =
-                Box::new(FileInputData::new(file_path)) as Box<dyn GenericInputData<T>>;
-            inputs.push(input_data);
+fn generate_inputs(data_dir: &str) -> Vec<Box<dyn GenericInputData>> {
+    // Opening the directory directly saves a separate `is_dir` stat up front;
+    // a path that is missing or not a directory is only told apart on error.
+    let dir = match fs::read_dir(data_dir) {
+        Ok(dir) => dir,
+        Err(err) if err.kind() == io::ErrorKind::NotFound || !Path::new(data_dir).is_dir() => {
+            return Vec::new();
+        }
+        Err(err) => panic!("Failed to read directory: {err:?}"),
+    };
+
+    let mut entries = Vec::new();
+    for entry in dir.flatten() {
+        // `DirEntry::file_type` reuses the type reported by the directory
+        // listing on most platforms, so no extra stat call per entry.
+        if !entry.file_type().is_ok_and(|file_type| file_type.is_file()) {
+            continue;
         }
+        let size = entry.metadata().map_or(0, |metadata| metadata.len());
+        entries.push((entry.path(), size));
     }
-    inputs
+
+    // Largest first, so the longest map jobs start early instead of
+    // straggling after everything else has finished.
+    entries.sort_unstable_by_key(|&(_, size)| Reverse(size));
+    entries
+        .into_iter()
+        .map(|(file_path, size)| {
+            Box::new(FileInputData::new(file_path, size)) as Box<dyn GenericInputData>
+        })
+        .collect()
 }
 
-fn create_workers(
-    input_list: Vec<Box<dyn GenericInputData<String>>>,
-) -> Vec<Arc<Mutex<dyn MapReducer>>> {
-    let mut workers = Vec::new();
+/// Inputs smaller than this are batched together rather than given a worker
+/// each, since spawning the job would cost more than counting them.
+const SMALL_INPUT_SIZE: u64 = 64 << 10;
+/// Upper bound on the number of small inputs in one batch.
+const MAX_BATCH_LEN: usize = 512;
+
+fn create_workers(input_list: Vec<Box<dyn GenericInputData>>) -> Vec<Box<dyn MapReducer>> {
+    // Both element types are two words, so collecting reuses the allocation
+    // of the batch list.
+    batch_inputs(input_list, available_cores())
+        .into_iter()
+        .map(|inputs| Box::new(LineCountWorker { inputs, result: 0 }) as Box<dyn MapReducer>)
+        .collect()
+}
 
+/// Splits `input_list` into the inputs of each worker: a large input on its
+/// own, small ones in batches.
+fn batch_inputs(
+    input_list: Vec<Box<dyn GenericInputData>>,
+    cores: usize,
+) -> Vec<Box<[Arc<dyn GenericInputData>]>> {
+    let small = input_list
+        .iter()
+        .filter(|input_data| input_data.size() < SMALL_INPUT_SIZE)
+        .count();
+    // Small inputs are spread over at least as many batches as there are
+    // cores, so a directory of small files still keeps every core busy.
+    let batch_len = small.div_ceil(cores).clamp(1, MAX_BATCH_LEN);
+
+    // The number of workers is known up front: one per large input plus the
+    // batches of small ones, so both lists are allocated once at their final
+    // size.
+    let mut workers = Vec::with_capacity(input_list.len() - small + small.div_ceil(batch_len));
+    let mut small_left = small;
+    let mut batch = Vec::with_capacity(small_left.min(batch_len));
+
+    // Batches are allocated at their exact length, so boxing them is free and
+    // saves the capacity word in every worker.
     for input_data in input_list {
-        let worker = Arc::new(Mutex::new(LineCountWorker {
-            input_data: input_data.into(),
-            result: 0,
-        }));
+        if input_data.size() >= SMALL_INPUT_SIZE {
+            workers.push(Box::new([input_data.into()]) as Box<[_]>);
+            continue;
+        }
 
-        workers.push(worker as Arc<Mutex<dyn MapReducer>>);
+        batch.push(input_data.into());
+        small_left -= 1;
+        if batch.len() == batch_len {
+            let next_batch = Vec::with_capacity(small_left.min(batch_len));
+            workers.push(mem::replace(&mut batch, next_batch).into_boxed_slice());
+        }
+    }
+    if !batch.is_empty() {
+        workers.push(batch.into_boxed_slice());
     }
 
     workers
 }
 
+/// Pool shared by every `execute` call. Small inputs are batched into larger
+/// jobs, so one thread per core is enough to keep the cores busy.
+static POOL: OnceLock<ThreadPool> = OnceLock::new();
+
+fn pool() -> &'static ThreadPool {
+    POOL.get_or_init(|| ThreadPool::new(available_cores()))
+}
+
+fn available_cores() -> usize {
+    thread::available_parallelism().map_or(1, NonZeroUsize::get)
+}
+
+/// Cores claimed by map work: one per queued or running worker, plus any
+/// extra cores a worker has reserved to split a very large input.
+static BUSY_CORES: AtomicUsize = AtomicUsize::new(0);
+
+/// Cores claimed in `BUSY_CORES`, released on drop, so they are given back
+/// even if the map step panics.
+struct CoreReservation(usize);
+
+impl CoreReservation {
+    /// Claims `cores` cores for work that is already queued, whether or not
+    /// they are idle.
+    fn claim(cores: usize) -> Self {
+        BUSY_CORES.fetch_add(cores, Ordering::AcqRel);
+        Self(cores)
+    }
+
+    /// Reserves up to `wanted` idle cores, possibly none.
+    fn take(wanted: usize) -> Self {
+        let cores = available_cores();
+        let mut taken = 0;
+        let _ = BUSY_CORES.fetch_update(Ordering::AcqRel, Ordering::Acquire, |busy| {
+            taken = cores.saturating_sub(busy).min(wanted);
+            Some(busy + taken)
+        });
+        Self(taken)
+    }
+}
+
+impl Drop for CoreReservation {
+    fn drop(&mut self) {
+        BUSY_CORES.fetch_sub(self.0, Ordering::AcqRel);
+    }
+}
+
+/// Runs the map step of every worker, then sums their results. Up to one pool
+/// job per core takes workers from a shared queue in order, so the next
+/// queued worker can prefetch its input while earlier ones are mapped. The
+/// queue is only locked to take a worker, never around the map step.
+fn execute(workers: Vec<Box<dyn MapReducer>>) -> usize {
+    // Queued workers count as busy too, so a worker only splits its input
+    // across cores that no other worker is waiting to use.
+    let jobs = workers.len();
+    let queue: VecDeque<_> = workers
+        .into_iter()
+        .map(|worker| (worker, CoreReservation::claim(1)))
+        .collect();
+    let queue = Arc::new(Mutex::new(queue));
+    let (result_tx, result_rx) = mpsc::channel();
+    let runners = available_cores().min(jobs);
+    if runners <= 1 {
+        run_queued(&queue, &result_tx);
+    } else {
+        for _ in 0..runners {
+            let queue = Arc::clone(&queue);
+            let result_tx = result_tx.clone();
+            pool().execute(move || run_queued(&queue, &result_tx));
+        }
+    }
+    drop(result_tx);
+
+    (0..jobs)
+        .map(|_| result_rx.recv().expect("A map worker panicked"))
+        .sum()
+}
+
+/// A worker waiting in the `execute` queue, with the core it has claimed.
+type QueuedWorker = (Box<dyn MapReducer>, CoreReservation);
+
+/// Maps workers from `queue` until it is empty, sending each result.
+fn run_queued(queue: &Mutex<VecDeque<QueuedWorker>>, results: &mpsc::Sender<usize>) {
+    loop {
+        let (mut worker, core) = {
+            let mut queue = queue.lock();
+            let Some(worker) = queue.pop_front() else {
+                return;
+            };
+            // Have the next worker's input read in the background while this
+            // one is mapped.
+            if let Some((next, _)) = queue.front() {
+                next.prefetch();
+            }
+            worker
+        };
+        worker.map();
+        drop(core);
+        let _ = results.send(worker.get_result());
+    }
+}
+
 fn main() {
-    let input_list = generate_inputs::<String>("test_inputs");
-    let mut workers = create_workers(input_list);
+    let input_list = generate_inputs("test_inputs");
+    let workers = create_workers(input_list);
+
+    println!("Lines: {}", execute(workers));
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// A fresh directory under the system temp dir, removed on drop.
+    struct TempDir(PathBuf);
+
+    impl TempDir {
+        fn new(name: &str) -> Self {
+            let path =
+                std::env::temp_dir().join(format!("rs_map_reduce-{}-{name}", std::process::id()));
+            let _ = fs::remove_dir_all(&path);
+            fs::create_dir_all(&path).expect("Failed to create temp dir");
+            Self(path)
+        }
+
+        fn path(&self, name: &str) -> String {
+            self.0.join(name).to_str().unwrap().to_owned()
+        }
+
+        fn write(&self, name: &str, contents: &[u8]) -> String {
+            let path = self.path(name);
+            fs::write(&path, contents).expect("Failed to write temp file");
+            path
+        }
+    }
+
+    impl Drop for TempDir {
+        fn drop(&mut self) {
+            let _ = fs::remove_dir_all(&self.0);
+        }
+    }
+
+    #[test]
+    fn generate_inputs_lists_regular_files_largest_first() {
+        let dir = TempDir::new("generate_inputs");
+        for (name, size) in [("b", 10), ("a", 3000), ("c", 0), ("d", 200)] {
+            dir.write(name, &vec![b'\n'; size]);
+        }
+        fs::create_dir(dir.path("sub")).unwrap();
+        dir.write("sub/nested", b"x\n");
+        #[cfg(unix)]
+        std::os::unix::fs::symlink(dir.path("a"), dir.path("link")).unwrap();
 
-    if let Some(first_worker) = workers.first().cloned() {
-        let mut first_worker = first_worker.lock();
+        let inputs = generate_inputs(&dir.path(""));
+        let sizes: Vec<_> = inputs.iter().map(|input_data| input_data.size()).collect();
+        assert_eq!(sizes, [3000, 200, 10, 0]);
+    }
+
+    #[test]
+    fn generate_inputs_is_empty_for_a_missing_or_non_directory_path() {
+        let dir = TempDir::new("generate_inputs_not_a_dir");
+        let file = dir.write("file", b"x\n");
+        assert!(generate_inputs(&dir.path("missing")).is_empty());
+        assert!(generate_inputs(&file).is_empty());
+    }
+
+    fn count_lines(input_data: &dyn GenericInputData) -> usize {
+        let mut counter = newline::LineCounter::default();
+        input_data.read_chunks(&mut |chunk| counter.feed(chunk));
+        counter.finish()
+    }
+
+    #[test]
+    fn read_chunks_counts_lines_like_str_lines() {
+        let dir = TempDir::new("read_chunks");
+        for text in ["", "\n", "a", "a\nb", "a\nb\n", "a\n\nb\n\n"] {
+            let path = dir.write("input", text.as_bytes());
+            let input_data = FileInputData::new(path.into(), text.len() as u64);
+            assert_eq!(count_lines(&input_data), text.lines().count(), "{text:?}");
+        }
+    }
+
+    #[cfg(unix)]
+    #[test]
+    fn read_chunks_streams_files_that_report_a_size_of_zero() {
+        // A FIFO reports a size of zero, like procfs entries do, so it cannot
+        // be mapped and goes through the streaming path.
+        let dir = TempDir::new("read_chunks_zero_size");
+        let path = dir.path("fifo");
+        let c_path = std::ffi::CString::new(path.clone()).unwrap();
+        // SAFETY: `c_path` is a valid, NUL-terminated path.
+        assert_eq!(unsafe { libc::mkfifo(c_path.as_ptr(), 0o600) }, 0);
+
+        // Several streaming buffers' worth, without a trailing newline.
+        let mut text = "line\n".repeat(READ_CHUNK_SIZE / 2);
+        text.push_str("last");
+        let writer = thread::spawn({
+            let path = path.clone();
+            let text = text.clone();
+            move || fs::write(path, text).expect("Failed to write FIFO")
+        });
+
+        let input_data = FileInputData::new(path.into(), 0);
+        assert_eq!(count_lines(&input_data), text.lines().count());
+        writer.join().unwrap();
+    }
+
+    /// An input that only has a size, for testing how inputs are batched.
+    struct SizedInput(u64);
 
-        for worker in workers.iter_mut().skip(1) {
-            let mut worker = worker.lock();
-            worker.map();
-            first_worker.reduce(&*worker);
+    impl GenericInputData for SizedInput {
+        fn size(&self) -> u64 {
+            self.0
         }
 
-        println!("Lines: {}", first_worker.get_result());
+        fn read_chunks(&self, _f: &mut dyn FnMut(&[u8])) {}
+    }
+
+    fn sized_inputs(sizes: &[u64]) -> Vec<Box<dyn GenericInputData>> {
+        sizes
+            .iter()
+            .map(|&size| Box::new(SizedInput(size)) as Box<dyn GenericInputData>)
+            .collect()
+    }
+
+    /// Batches inputs of the given sizes and returns the sizes in each batch.
+    fn batch_sizes(sizes: &[u64], cores: usize) -> Vec<Vec<u64>> {
+        let workers = batch_inputs(sized_inputs(sizes), cores);
+        assert_eq!(workers.capacity(), workers.len());
+        workers
+            .iter()
+            .map(|inputs| inputs.iter().map(|input_data| input_data.size()).collect())
+            .collect()
+    }
+
+    #[test]
+    fn batch_inputs_spreads_small_inputs_over_every_core() {
+        let large = SMALL_INPUT_SIZE;
+        let sizes = [large * 3, large * 2, large, 9, 8, 7, 6, 5, 4, 3, 2, 1, 0];
+        assert_eq!(
+            batch_sizes(&sizes, 4),
+            [
+                vec![large * 3],
+                vec![large * 2],
+                vec![large],
+                vec![9, 8, 7],
+                vec![6, 5, 4],
+                vec![3, 2, 1],
+                vec![0],
+            ]
+        );
+        // Large inputs keep their own worker wherever they appear.
+        assert_eq!(
+            batch_sizes(&[1, large, 2, 3], 1),
+            [vec![large], vec![1, 2, 3]]
+        );
+    }
+
+    #[test]
+    fn batch_inputs_caps_the_batch_length() {
+        let batches = batch_sizes(&vec![1; 2 * MAX_BATCH_LEN + 3], 1);
+        let lens: Vec<_> = batches.iter().map(Vec::len).collect();
+        assert_eq!(lens, [MAX_BATCH_LEN, MAX_BATCH_LEN, 3]);
+    }
+
+    #[test]
+    fn batch_inputs_handles_no_inputs_and_only_large_inputs() {
+        assert!(batch_sizes(&[], 4).is_empty());
+        assert!(create_workers(Vec::new()).is_empty());
+
+        let large = SMALL_INPUT_SIZE;
+        assert_eq!(
+            batch_sizes(&[large + 2, large + 1, large], 8),
+            [vec![large + 2], vec![large + 1], vec![large]]
+        );
+    }
+
+    #[test]
+    fn create_workers_makes_one_worker_per_batch() {
+        let sizes: Vec<_> = (0..100).chain([SMALL_INPUT_SIZE; 3]).collect();
+        let workers = create_workers(sized_inputs(&sizes));
+        assert_eq!(workers.len(), batch_sizes(&sizes, available_cores()).len());
+        assert_eq!(workers.capacity(), workers.len());
     }
 }
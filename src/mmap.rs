@@ -0,0 +1,81 @@
+use std::{fs::File, io, ops::Deref, os::unix::io::AsRawFd, ptr, slice};
+
+/// A read-only, private memory map of a whole file, unmapped on drop.
+pub struct Mmap {
+    ptr: *mut libc::c_void,
+    len: usize,
+}
+
+// SAFETY: the mapping is read-only and owned exclusively by this value.
+unsafe impl Send for Mmap {}
+unsafe impl Sync for Mmap {}
+
+impl Mmap {
+    /// Maps `file` and asks the kernel to start reading it in. With
+    /// `sequential`, also advises that it will be read from start to end;
+    /// leave it off when the map is scanned from several offsets at once.
+    /// The file descriptor may be closed once this returns.
+    ///
+    /// Fails for files that report a size of zero. mmap rejects those, and
+    /// pseudo-files such as procfs entries report zero while still having
+    /// content, so callers should read such files instead.
+    ///
+    /// # Safety
+    ///
+    /// The caller must ensure the file is neither truncated nor modified while
+    /// the map is alive: truncation makes reads of the lost pages raise
+    /// SIGBUS, and writes change bytes behind the shared `&[u8]`.
+    pub unsafe fn map(file: &File, sequential: bool) -> io::Result<Self> {
+        let len = usize::try_from(file.metadata()?.len())
+            .map_err(|_| io::Error::new(io::ErrorKind::InvalidInput, "file too large to map"))?;
+        if len == 0 {
+            return Err(io::Error::new(
+                io::ErrorKind::InvalidInput,
+                "cannot map a file that reports a size of zero",
+            ));
+        }
+
+        // SAFETY: fresh mapping of `len` bytes of a valid, open file descriptor.
+        let ptr = unsafe {
+            libc::mmap(
+                ptr::null_mut(),
+                len,
+                libc::PROT_READ,
+                libc::MAP_PRIVATE,
+                file.as_raw_fd(),
+                0,
+            )
+        };
+        if ptr == libc::MAP_FAILED {
+            return Err(io::Error::last_os_error());
+        }
+
+        // Advice is only a hint, so failures are ignored.
+        // SAFETY: `ptr..ptr + len` is the mapping created above.
+        unsafe {
+            if sequential {
+                libc::madvise(ptr, len, libc::MADV_SEQUENTIAL);
+            }
+            libc::madvise(ptr, len, libc::MADV_WILLNEED);
+        }
+        Ok(Self { ptr, len })
+    }
+}
+
+impl Deref for Mmap {
+    type Target = [u8];
+
+    fn deref(&self) -> &[u8] {
+        // SAFETY: the mapping stays valid and readable until `self` is dropped.
+        unsafe { slice::from_raw_parts(self.ptr as *const u8, self.len) }
+    }
+}
+
+impl Drop for Mmap {
+    fn drop(&mut self) {
+        // SAFETY: unmaps exactly the region mapped in `Mmap::map`.
+        unsafe {
+            libc::munmap(self.ptr, self.len);
+        }
+    }
+}
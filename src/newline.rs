@@ -0,0 +1,312 @@
+use std::thread;
+
+/// Chunks at least this large are worth splitting across threads: one core
+/// cannot use all of the memory bandwidth, and the spawn cost is negligible at
+/// this size.
+pub const SPLIT_THRESHOLD: usize = 256 << 20;
+
+/// Counts the `\n` bytes in `buf` on `threads` threads, one slice each. Zero
+/// or one thread counts on the calling thread.
+pub fn count_newlines_split(buf: &[u8], threads: usize) -> usize {
+    if threads <= 1 || buf.is_empty() {
+        return count_newlines(buf);
+    }
+    let slice_len = buf.len().div_ceil(threads);
+    thread::scope(|scope| {
+        let handles: Vec<_> = buf
+            .chunks(slice_len)
+            .map(|slice| scope.spawn(move || count_newlines(slice)))
+            .collect();
+        handles
+            .into_iter()
+            .map(|handle| handle.join().expect("Newline counting thread panicked"))
+            .sum()
+    })
+}
+
+/// Counts the `\n` bytes in `buf`.
+pub fn count_newlines(buf: &[u8]) -> usize {
+    #[cfg(target_arch = "x86_64")]
+    {
+        if is_x86_feature_detected!("avx2") {
+            // SAFETY: the CPU supports AVX2, checked just above.
+            return unsafe { count_newlines_avx2(buf) };
+        }
+    }
+    count_newlines_scalar(buf)
+}
+
+/// Counts lines over input fed in chunks, the same way `str::lines().count()`
+/// does over the whole input: a trailing line without a terminating `\n`
+/// still counts as a line.
+#[derive(Default)]
+pub struct LineCounter {
+    newlines: usize,
+    last: Option<u8>,
+}
+
+impl LineCounter {
+    pub fn feed(&mut self, chunk: &[u8]) {
+        self.feed_split(chunk, 1);
+    }
+
+    /// Like `feed`, but counts `chunk` on `threads` threads.
+    pub fn feed_split(&mut self, chunk: &[u8], threads: usize) {
+        self.newlines += count_newlines_split(chunk, threads);
+        if let Some(&last) = chunk.last() {
+            self.last = Some(last);
+        }
+    }
+
+    pub fn finish(&self) -> usize {
+        match self.last {
+            Some(last) if last != b'\n' => self.newlines + 1,
+            _ => self.newlines,
+        }
+    }
+}
+
+#[cfg(any(
+    target_feature = "sse2",
+    target_feature = "neon",
+    target_feature = "simd128"
+))]
+use self::count_newlines_lanes as count_newlines_scalar;
+#[cfg(not(any(
+    target_feature = "sse2",
+    target_feature = "neon",
+    target_feature = "simd128"
+)))]
+use self::count_newlines_swar as count_newlines_scalar;
+
+/// Portable counter written so LLVM vectorizes it for whatever SIMD the target
+/// has: matches are accumulated into byte lanes, flushed before any lane can
+/// overflow (255 blocks), instead of widening every match to `usize`.
+#[cfg(any(
+    test,
+    target_feature = "sse2",
+    target_feature = "neon",
+    target_feature = "simd128"
+))]
+fn count_newlines_lanes(buf: &[u8]) -> usize {
+    const LANES: usize = 32;
+
+    let mut count = 0;
+    let mut blocks = buf.chunks_exact(LANES * 255);
+    for block in &mut blocks {
+        let mut lanes = [0u8; LANES];
+        for chunk in block.chunks_exact(LANES) {
+            for (lane, &byte) in lanes.iter_mut().zip(chunk) {
+                *lane += u8::from(byte == b'\n');
+            }
+        }
+        count += lanes.iter().map(|&lane| usize::from(lane)).sum::<usize>();
+    }
+    count + blocks.remainder().iter().filter(|&&b| b == b'\n').count()
+}
+
+/// Branchless SWAR counter for targets without SIMD registers, where the lane
+/// loop above would not vectorize: each `u64` word is tested for `\n` in all
+/// eight bytes at once.
+#[cfg(any(
+    test,
+    not(any(
+        target_feature = "sse2",
+        target_feature = "neon",
+        target_feature = "simd128"
+    ))
+))]
+fn count_newlines_swar(buf: &[u8]) -> usize {
+    const LOW7: u64 = u64::from_ne_bytes([0x7f; 8]);
+    const NEEDLE: u64 = u64::from_ne_bytes([b'\n'; 8]);
+    const EVEN_BYTES: u64 = u64::from_ne_bytes([0xff, 0, 0xff, 0, 0xff, 0, 0xff, 0]);
+
+    // Sets the low bit of every byte of `word` that is `\n`. Unlike the
+    // `(x - 0x01..) & !x` trick no borrow crosses bytes, so the result is exact.
+    let matches = |word: u64| {
+        let v = word ^ NEEDLE;
+        !(((v & LOW7) + LOW7) | v | LOW7) >> 7
+    };
+    // Sums the eight byte lanes of `acc`.
+    let sum_lanes = |acc: u64| {
+        let pairs = (acc & EVEN_BYTES) + ((acc >> 8) & EVEN_BYTES);
+        (pairs.wrapping_mul(0x0001_0001_0001_0001) >> 48) as usize
+    };
+
+    let mut count = 0;
+    let mut tail: &[u8] = &[];
+    // Byte lanes hold at most 255 matches, so flush every 255 words.
+    for block in buf.chunks(8 * 255) {
+        let mut words = block.chunks_exact(8);
+        let mut acc = 0u64;
+        for word in &mut words {
+            acc += matches(u64::from_ne_bytes(word.try_into().unwrap()));
+        }
+        count += sum_lanes(acc);
+        tail = words.remainder();
+    }
+    count + tail.iter().filter(|&&b| b == b'\n').count()
+}
+
+#[cfg(target_arch = "x86_64")]
+#[target_feature(enable = "avx2")]
+unsafe fn count_newlines_avx2(buf: &[u8]) -> usize {
+    use std::arch::x86_64::*;
+
+    let needle = _mm256_set1_epi8(b'\n' as i8);
+    let zero = _mm256_setzero_si256();
+    let mut totals = zero;
+    let mut tail: &[u8] = &[];
+
+    // Matches are summed per byte lane and folded into the 64-bit totals with
+    // a single SAD every 255 vectors, before any lane can overflow, instead of
+    // a movemask and popcount per vector.
+    for block in buf.chunks(32 * 255) {
+        let mut chunks = block.chunks_exact(32);
+        let mut lanes = zero;
+        for chunk in &mut chunks {
+            let bytes = _mm256_loadu_si256(chunk.as_ptr() as *const __m256i);
+            // A match compares as -1, so subtracting it adds one to the lane.
+            lanes = _mm256_sub_epi8(lanes, _mm256_cmpeq_epi8(bytes, needle));
+        }
+        totals = _mm256_add_epi64(totals, _mm256_sad_epu8(lanes, zero));
+        tail = chunks.remainder();
+    }
+
+    let mut sums = [0u64; 4];
+    _mm256_storeu_si256(sums.as_mut_ptr() as *mut __m256i, totals);
+    sums.iter().sum::<u64>() as usize + count_newlines_scalar(tail)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn naive(buf: &[u8]) -> usize {
+        buf.iter().filter(|&&b| b == b'\n').count()
+    }
+
+    /// Buffers around the flush boundaries of every kernel (8 * 255 bytes for
+    /// SWAR, 32 * 255 for the lane and AVX2 counters), filled with newlines
+    /// only, random bytes, and bytes that differ from `\n` in a single bit.
+    fn buffers() -> Vec<Vec<u8>> {
+        let mut seed = 0x2545_f491_4f6c_dd1d_u64;
+        let mut random_byte = move || {
+            seed ^= seed << 13;
+            seed ^= seed >> 7;
+            seed ^= seed << 17;
+            (seed >> 24) as u8
+        };
+        let near_misses = [0x8a, b'\n', 0x0b, 0x09, 0x00, 0xff, 0x01, 0x8a, 0x8a];
+
+        let mut buffers = Vec::new();
+        for len in [
+            0,
+            1,
+            7,
+            8,
+            9,
+            31,
+            32,
+            33,
+            8 * 255 - 1,
+            8 * 255,
+            8 * 255 + 1,
+            32 * 255 - 1,
+            32 * 255,
+            32 * 255 + 1,
+            2 * 32 * 255 + 17,
+            100_000,
+        ] {
+            buffers.push(vec![b'\n'; len]);
+            buffers.push((0..len).map(|_| random_byte()).collect());
+            buffers.push(
+                (0..len)
+                    .map(|i| near_misses[i % near_misses.len()])
+                    .collect(),
+            );
+        }
+        buffers
+    }
+
+    fn assert_matches_naive(count: impl Fn(&[u8]) -> usize) {
+        for buf in buffers() {
+            for offset in 0..buf.len().min(8) {
+                let slice = &buf[offset..];
+                assert_eq!(
+                    count(slice),
+                    naive(slice),
+                    "len {} offset {offset}",
+                    buf.len()
+                );
+            }
+        }
+    }
+
+    #[test]
+    fn lane_counter_matches_naive() {
+        assert_matches_naive(count_newlines_lanes);
+    }
+
+    #[test]
+    fn swar_counter_matches_naive() {
+        assert_matches_naive(count_newlines_swar);
+    }
+
+    #[cfg(target_arch = "x86_64")]
+    #[test]
+    fn avx2_counter_matches_naive() {
+        if !is_x86_feature_detected!("avx2") {
+            return;
+        }
+        // SAFETY: the CPU supports AVX2, checked just above.
+        assert_matches_naive(|buf| unsafe { count_newlines_avx2(buf) });
+    }
+
+    #[test]
+    fn count_newlines_matches_naive() {
+        assert_matches_naive(count_newlines);
+    }
+
+    #[test]
+    fn split_count_matches_naive() {
+        for threads in [0, 1, 2, 3, 7] {
+            assert_matches_naive(|buf| count_newlines_split(buf, threads));
+        }
+    }
+
+    #[test]
+    fn line_counter_matches_str_lines_at_every_split() {
+        for text in [
+            "",
+            "\n",
+            "a",
+            "a\n",
+            "a\nb",
+            "a\n\nb\n",
+            "\n\nx",
+            "ab\ncd\n\n",
+        ] {
+            let expected = text.lines().count();
+            let bytes = text.as_bytes();
+            for split in 0..=bytes.len() {
+                let mut counter = LineCounter::default();
+                counter.feed(&bytes[..split]);
+                counter.feed(&bytes[split..]);
+                assert_eq!(counter.finish(), expected, "{text:?} split at {split}");
+
+                let mut counter = LineCounter::default();
+                counter.feed_split(&bytes[..split], 3);
+                counter.feed_split(&bytes[split..], 2);
+                assert_eq!(counter.finish(), expected, "{text:?} split at {split}");
+            }
+
+            let mut counter = LineCounter::default();
+            for byte in bytes.chunks(1) {
+                counter.feed(byte);
+            }
+            counter.feed(&[]);
+            assert_eq!(counter.finish(), expected, "{text:?} byte by byte");
+        }
+    }
+}
@@ -0,0 +1,46 @@
+use std::{
+    sync::{mpsc, Arc},
+    thread,
+};
+
+use parking_lot::Mutex;
+
+type Job = Box<dyn FnOnce() + Send + 'static>;
+
+/// A fixed set of long-lived threads pulling jobs from a shared queue, so
+/// thread start-up is paid once per process rather than once per job.
+pub struct ThreadPool {
+    sender: mpsc::Sender<Job>,
+}
+
+impl ThreadPool {
+    pub fn new(size: usize) -> Self {
+        let (sender, receiver) = mpsc::channel::<Job>();
+        let receiver = Arc::new(Mutex::new(receiver));
+
+        for id in 0..size.max(1) {
+            let receiver = Arc::clone(&receiver);
+            thread::Builder::new()
+                .name(format!("map-worker-{id}"))
+                .spawn(move || loop {
+                    let job = receiver.lock().recv();
+                    match job {
+                        Ok(job) => job(),
+                        Err(_) => break,
+                    }
+                })
+                .expect("Failed to spawn pool thread");
+        }
+
+        Self { sender }
+    }
+
+    pub fn execute<F>(&self, job: F)
+    where
+        F: FnOnce() + Send + 'static,
+    {
+        self.sender
+            .send(Box::new(job))
+            .expect("Thread pool has shut down");
+    }
+}